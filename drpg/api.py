@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from typing import TYPE_CHECKING
 
@@ -10,6 +11,7 @@ from drpg.types import PrepareDownloadUrlResponse
 
 if TYPE_CHECKING:  # pragma: no cover
     from collections.abc import Iterator
+    from typing import Any
 
     from drpg.types import Product, TokenResponse
 
@@ -17,21 +19,33 @@ logger = logging.getLogger("drpg")
 JSON_MIME = "application/json"
 
 
+def is_transient_error(error: httpx.HTTPError) -> bool:
+    """Tell if a request that failed with the error may succeed when sent again."""
+
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.is_server_error
+    return isinstance(error, httpx.TransportError)
+
+
 class DrpgApi:
     """Low-level REST API client for DriveThruRPG"""
 
     API_URL = "https://api.drivethrurpg.com/api/vBeta/"
+    RETRIES = 3
 
     class PrepareDownloadUrlException(Exception):
         UNEXPECTED_RESPONSE = "Got response with unexpected schema"
         REQUEST_FAILED = "Got non 2xx response"
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, transport: httpx.BaseTransport | None = None):
         logger.debug("Preparing httpx client")
+        # No custom transport by default, so httpx still configures proxies from the
+        # environment. Failed requests are retried by `_get` instead.
         self._client = httpx.Client(
             base_url=self.API_URL,
             http1=False,
             http2=True,
+            transport=transport,
             timeout=30.0,
             headers={
                 "Content-Type": JSON_MIME,
@@ -62,10 +76,14 @@ class DrpgApi:
 
         page = 1
 
-        while result := self._product_page(page, per_page):
-            logger.debug("Yielding products page %d", page)
-            yield from result
-            page += 1
+        # Fetch the next page in the background while the current one is consumed
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(self._product_page, page, per_page)
+            while result := next_page.result():
+                next_page = executor.submit(self._product_page, page + 1, per_page)
+                logger.debug("Yielding products page %d", page)
+                yield from result
+                page += 1
 
     def prepare_download_url(self, product_id: int, item_id: int) -> PrepareDownloadUrlResponse:
         """Generate a download link and metadata for a product's item."""
@@ -75,7 +93,7 @@ class DrpgApi:
             "index": item_id,
             "getChecksums": 0,  # Official clients defaults to 1
         }
-        resp = self._client.get(f"order_products/{product_id}/prepare", params=task_params)
+        resp = self._get(f"order_products/{product_id}/prepare", task_params)
 
         def _parse_message(resp) -> PrepareDownloadUrlResponse:
             message: PrepareDownloadUrlResponse = resp.json()
@@ -108,7 +126,7 @@ class DrpgApi:
         while (data := _parse_message(resp))["status"].startswith("Preparing"):
             logger.debug("Waiting for download link for: %s - %s", product_id, item_id)
             sleep(2)
-            resp = self._client.get(f"order_products/{product_id}/check", params=task_params)
+            resp = self._get(f"order_products/{product_id}/check", task_params)
 
         logger.debug("Got download link for: %s - %s", product_id, item_id)
         return data
@@ -116,9 +134,9 @@ class DrpgApi:
     def _product_page(self, page: int, per_page: int) -> list[Product]:
         """List products from a specified page."""
 
-        return self._client.get(
+        return self._get(
             "order_products",
-            params={
+            {
                 "getChecksum": 1,
                 "getFilters": 0,  # Official clients defaults to 1
                 "page": page,
@@ -127,3 +145,21 @@ class DrpgApi:
                 "archived": 0,
             },
         ).json()
+
+    def _get(self, url: str, params: dict[str, Any]) -> httpx.Response:
+        """Send a GET request, retrying with an exponential backoff on transient errors."""
+
+        for attempt in range(self.RETRIES):
+            try:
+                resp = self._client.get(url, params=params)
+                resp.raise_for_status()
+                return resp
+            except httpx.HTTPError as e:
+                if not is_transient_error(e):
+                    # Callers handle responses with client errors themselves
+                    if isinstance(e, httpx.HTTPStatusError):
+                        return e.response
+                    raise
+                logger.debug("Retrying %s after error: %s", url, e)
+            sleep(2**attempt)
+        return self._client.get(url, params=params)
@@ -19,9 +19,12 @@ import drpg
 from drpg.config import Config
 
 if TYPE_CHECKING:  # pragma: no cover
+    from collections.abc import Callable, Mapping
     from types import FrameType, TracebackType
+    from typing import IO
 
     CliArgs = list[str]
+    Opener = Callable[..., IO[str]]
 
 __all__ = ["run"]
 
@@ -76,6 +79,13 @@ def _parse_cli(args: CliArgs | None = None) -> Config:
         default=environ.get("DRPG_VALIDATE", "false").lower() == "true",
         help="Validate downloads by calculating checksums",
     )
+    parser.add_argument(
+        "--link-duplicates",
+        action="store_true",
+        default=environ.get("DRPG_LINK_DUPLICATES", "false").lower() == "true",
+        help="Hard link files shared by products instead of downloading them again. "
+        "Requires --validate",
+    )
     parser.add_argument(
         "--log-level",
         default=environ.get("DRPG_LOG_LEVEL", "INFO"),
@@ -111,15 +121,19 @@ def _parse_cli(args: CliArgs | None = None) -> Config:
         help="Omit the publisher name in the target path.",
     )
 
-    return parser.parse_args(args, namespace=Config())
+    config = parser.parse_args(args, namespace=Config())
+    # Only validated downloads are linked, so linking without validation would do nothing
+    if config.link_duplicates and not config.validate:
+        parser.error("--link-duplicates requires --validate")
+    return config
 
 
-def _default_dir() -> Path:
+def _default_dir(env: Mapping[str, str] = environ, opener: Opener = open) -> Path:
     os_name = platform.system()
     if os_name == "Linux":
-        xdg_config = Path(environ.get("XDG_CONFIG_HOME", "~/.config")).expanduser()
+        xdg_config = Path(env.get("XDG_CONFIG_HOME", "~/.config")).expanduser()
         try:
-            with open(xdg_config / "user-dirs.dirs") as f:
+            with opener(xdg_config / "user-dirs.dirs") as f:
                 raw_config = "[xdg]\n" + f.read().replace('"', "")
             config = configparser.ConfigParser()
             config.read_string(raw_config)
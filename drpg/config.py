@@ -10,6 +10,7 @@ class Config:
     library_path: Path
     use_checksums: bool
     validate: bool
+    link_duplicates: bool
     log_level: str
     dry_run: bool
     compatibility_mode: bool
@@ -2,20 +2,29 @@ from __future__ import annotations
 
 import functools
 import html
+import json
 import logging
+import os.path
 import re
-from datetime import datetime, timedelta
+import sys
+import threading
+from datetime import datetime, timezone
 from hashlib import md5
 from multiprocessing.pool import ThreadPool
-from time import timezone
+from operator import itemgetter
+from pathlib import Path
+from time import sleep
 from typing import TYPE_CHECKING
 
 import httpx
 
-from drpg.api import DrpgApi
+from drpg.api import DrpgApi, is_transient_error
+from drpg.types import SyncProduct
+
+if sys.version_info >= (3, 11):
+    from hashlib import file_digest
 
 if TYPE_CHECKING:  # pragma: no cover
-    from pathlib import Path
     from typing import Any, Callable
 
     from drpg.config import Config
@@ -26,6 +35,13 @@ if TYPE_CHECKING:  # pragma: no cover
 
 logger = logging.getLogger("drpg")
 
+# Size of chunks in which files are downloaded and read to calculate checksums
+CHUNK_SIZE = 1024 * 1024
+# How many times a file is downloaded before giving up on its invalid checksum
+DOWNLOAD_ATTEMPTS = 2
+# Name of the file in the library directory where local files' checksums are kept
+CHECKSUMS_FILE = ".drpg_checksums.json"
+
 
 def suppress_errors(*errors: type[Exception]) -> Decorator:
     """Silence but log provided errors."""
@@ -49,6 +65,31 @@ class DrpgSync:
     def __init__(self, config: Config) -> None:
         self._config = config
         self._api = DrpgApi(config.token)
+        self._library_dir = os.fspath(config.library_path)
+        self._product_dirs: dict[tuple[str, str], str] = {}
+        self._created_dirs: set[Path] = set()
+        # Paths of validated items downloaded in this sync by their checksums
+        self._downloaded: dict[str, Path] = {}
+        # Set when the sync is interrupted, so workers stop instead of finishing their items
+        self._cancel = threading.Event()
+        self._checksums = (
+            _ChecksumCache(Path(self._library_dir, CHECKSUMS_FILE))
+            if config.use_checksums
+            else None
+        )
+        # Shared by all downloads, so connections to the file host are reused between items
+        self._http = httpx.Client(
+            timeout=30.0,
+            follow_redirects=True,
+            headers={
+                "Accept-Encoding": "gzip, deflate, br",
+                "User-Agent": "Mozilla/5.0",
+                "Accept": "*/*",
+            },
+            limits=httpx.Limits(
+                max_connections=config.threads, max_keepalive_connections=config.threads
+            ),
+        )
 
     def sync(self) -> None:
         """Download all new, updated and not yet synced items to a sync directory."""
@@ -56,54 +97,105 @@ class DrpgSync:
         logger.info("Authenticating")
         self._api.token()
         logger.info("Fetching products list")
-        process_item_args = (
-            (product, item)
+        # A generator, so items are synced while next pages of products are fetched
+        products_items = (
+            (slim_product, item)
             for product in self._api.customer_products()
+            for slim_product in (_slim_product(product),)
             for item in product["files"]
-            if self._need_download(product, item)
         )
 
-        with ThreadPool(self._config.threads) as pool:
-            pool.starmap(self._process_item, process_item_args)
+        pool = ThreadPool(self._config.threads)
+        try:
+            # Items vary a lot in size, so hand them out one by one to keep all threads
+            # busy. Products are fetched in this thread, so an interrupt stops it at once.
+            for product_item in products_items:
+                pool.apply_async(self._sync_item, (product_item,))
+            pool.close()
+            pool.join()
+        except BaseException:
+            # Don't wait for items being synced, workers stop at their next chunk
+            self._cancel.set()
+            pool.terminate()
+            self._save_checksums(prune=False)
+            raise
+        self._http.close()
+        self._save_checksums(prune=True)
         logger.info("Done!")
 
-    @suppress_errors(httpx.HTTPError, PermissionError)
-    def _process_item(self, product: Product, item: DownloadItem) -> None:
+    def _save_checksums(self, *, prune: bool) -> None:
+        if self._checksums is None or self._config.dry_run:
+            return
+        try:
+            self._checksums.save(prune=prune)
+        except OSError as e:
+            logger.warning("Could not save checksums of local files: %s", e)
+
+    def _sync_item(self, product_item: tuple[SyncProduct, DownloadItem]) -> None:
+        """
+        Download the item if it is missing or outdated in the sync directory.
+        Takes a (product, item) pair, as the thread pool passes a single argument.
+        """
+
+        if self._cancel.is_set():
+            return
+
+        product, item = product_item
+        # Checked in a worker thread, so files are hashed in parallel when
+        # checksums are used - hashlib releases the GIL while digesting.
+        try:
+            if self._need_download(product, item):
+                self._process_item(product, item)
+        except _SyncCancelled:
+            logger.debug("Cancelled: %s - %s", product["name"], item["filename"])
+        except Exception as e:
+            # The pool would stop syncing all other items on an error, just log it
+            logger.exception(e)
+
+    def _process_item(self, product: SyncProduct, item: DownloadItem) -> None:
         """Prepare for and download the item to the sync directory."""
 
         path = self._file_path(product, item)
 
         if self._config.dry_run:
             logger.info("DRY RUN - would have downloaded file: %s", path)
-        else:
-            logger.info("Processing: %s - %s", product["name"], item["filename"])
+            return
 
-            try:
-                url_data = self._api.prepare_download_url(product["orderProductId"], item["index"])
-            except self._api.PrepareDownloadUrlException:
-                logger.warning(
-                    "Could not download product: %s - %s",
-                    product["name"],
-                    item["filename"],
-                )
-                return
+        logger.info("Processing: %s - %s", product["name"], item["filename"])
 
-            file_response = httpx.get(
-                url_data["url"],
-                timeout=30.0,
-                follow_redirects=True,
-                headers={
-                    "Accept-Encoding": "gzip, deflate, br",
-                    "User-Agent": "Mozilla/5.0",
-                    "Accept": "*/*",
-                },
-            )
+        # Bundles often contain the same files as the products they are made of
+        newest_checksum = _newest_checksum(item)
+        if (
+            self._config.link_duplicates
+            and newest_checksum
+            and self._link_downloaded(newest_checksum, path)
+        ):
+            return
+
+        # Errors are caught here rather than with `suppress_errors` to avoid
+        # an extra wrapper call for every processed item.
+        try:
+            url_data = self._api.prepare_download_url(product["orderProductId"], item["index"])
 
-            if (
-                self._config.validate
-                and (api_checksum := _newest_checksum(item))
-                and (local_checksum := md5(file_response.content).hexdigest()) != api_checksum
-            ):
+            self._make_dir(path.parent)
+            download_path = path.with_name(f"{path.name}.part")
+            api_checksum = newest_checksum if self._config.validate else None
+
+            for _ in range(DOWNLOAD_ATTEMPTS):
+                local_checksum = self._download_with_retries(
+                    url_data["url"], download_path, checksum=api_checksum is not None
+                )
+                if local_checksum == api_checksum:
+                    self._move_download(download_path, path)
+                    # Only validated files are linked, a corrupted one isn't spread further
+                    if api_checksum:
+                        self._downloaded[api_checksum] = path
+                    break
+                logger.debug(
+                    "Invalid checksum for %s - %s, retrying", product["name"], item["filename"]
+                )
+            else:
+                download_path.unlink()
                 logger.error(
                     "ERROR: Invalid checksum for %s - %s, skipping saving file (%s != %s))",
                     product["name"],
@@ -111,28 +203,108 @@ class DrpgSync:
                     api_checksum,
                     local_checksum,
                 )
-            else:
-                path.parent.mkdir(parents=True, exist_ok=True)
-                path.write_bytes(file_response.content)
-
-    def _need_download(self, product: Product, item: DownloadItem) -> bool:
+        except self._api.PrepareDownloadUrlException:
+            logger.warning(
+                "Could not download product: %s - %s",
+                product["name"],
+                item["filename"],
+            )
+        except (httpx.HTTPError, PermissionError) as e:
+            logger.exception(e)
+
+    def _move_download(self, download_path: Path, path: Path) -> None:
+        """Move a finished download in place, removing it if that fails."""
+
+        try:
+            download_path.replace(path)
+        except OSError:
+            download_path.unlink(missing_ok=True)
+            raise
+
+    def _link_downloaded(self, checksum: str, path: Path) -> bool:
+        """
+        Hard link the path to a file with the same checksum downloaded earlier in this sync.
+        Return whether the file was linked.
+        """
+
+        if (source := self._downloaded.get(checksum)) is None:
+            return False
+
+        link_path = path.with_name(f"{path.name}.part")
+        try:
+            self._make_dir(path.parent)
+            os.link(source, link_path)
+            link_path.replace(path)
+        except OSError as e:
+            # Not every file system supports hard links, download the file instead
+            logger.debug("Could not link %s to %s: %s", path, source, e)
+            link_path.unlink(missing_ok=True)
+            return False
+
+        logger.info("Linked: %s to %s", path, source)
+        return True
+
+    def _make_dir(self, path: Path) -> None:
+        # Products have many items in the same directory, create it only once
+        if path not in self._created_dirs:
+            path.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(path)
+
+    def _download_with_retries(self, url: str, path: Path, *, checksum: bool = False) -> str | None:
+        """Download a file, retrying with an exponential backoff on transient errors."""
+
+        for attempt in range(DrpgApi.RETRIES):
+            try:
+                return self._download_from_url(url, path, checksum=checksum)
+            except httpx.HTTPError as e:
+                if not is_transient_error(e):
+                    raise
+                logger.debug("Retrying download of %s after error: %s", path, e)
+            sleep(2**attempt)
+        return self._download_from_url(url, path, checksum=checksum)
+
+    def _download_from_url(self, url: str, path: Path, *, checksum: bool = False) -> str | None:
+        """
+        Stream a file to the path in chunks, removing it if the download fails.
+        If requested, return the file's MD5 checksum calculated from the streamed chunks.
+        """
+
+        file_md5 = md5() if checksum else None
+        try:
+            with self._http.stream("GET", url) as response:
+                response.raise_for_status()
+                with path.open("wb") as f:
+                    for chunk in response.iter_bytes(CHUNK_SIZE):
+                        if self._cancel.is_set():
+                            raise _SyncCancelled
+                        f.write(chunk)
+                        if file_md5:
+                            file_md5.update(chunk)
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+        return file_md5.hexdigest() if file_md5 else None
+
+    def _need_download(self, product: SyncProduct, item: DownloadItem) -> bool:
         """Specify whether or not the item needs to be downloaded."""
 
         path = self._file_path(product, item)
 
-        if not path.exists():
+        # A single stat tells both if the file exists and when it was modified
+        try:
+            stat = path.stat()
+        except OSError as e:
+            # Like Path.exists(), treat paths that can't be checked - e.g. with a file in
+            # place of a directory - as missing files, rather than stop the whole sync.
             logger.debug(
-                "Needs download: %s - %s: local file does not exist",
+                "Needs download: %s - %s: local file does not exist (%s)",
                 product["name"],
                 item["filename"],
+                e,
             )
             return True
 
-        remote_time = datetime.fromisoformat(product["fileLastModified"]).utctimetuple()
-        local_time = (
-            datetime.fromtimestamp(path.stat().st_mtime) + timedelta(seconds=timezone)
-        ).utctimetuple()
-        if remote_time > local_time:
+        if _timestamp(product["fileLastModified"]) > stat.st_mtime:
             logger.debug(
                 "Needs download: %s - %s: local file is outdated",
                 product["name"],
@@ -140,33 +312,110 @@ class DrpgSync:
             )
             return True
 
-        if (
-            self._config.use_checksums
-            and (checksum := _newest_checksum(item))
-            and md5(path.read_bytes()).hexdigest() != checksum
-        ):
-            logger.debug(
-                "Needs download: %s - %s: unmatching checksum",
-                product["name"],
-                item["filename"],
-            )
-            return True
+        if self._checksums is not None:
+            checksum = _newest_checksum(item)
+            if checksum and self._checksums.get(path, stat) != checksum:
+                logger.debug(
+                    "Needs download: %s - %s: unmatching checksum",
+                    product["name"],
+                    item["filename"],
+                )
+                return True
 
         logger.info("Up to date: %s - %s", product["name"], item["filename"])
         return False
 
-    def _file_path(self, product: Product, item: DownloadItem) -> Path:
-        publishers_name = _normalize_path_part(
-            product.get("publisher", {}).get("name", "Others"), self._config.compatibility_mode
-        )
-        product_name = _normalize_path_part(product["name"], self._config.compatibility_mode)
+    def _file_path(self, product: SyncProduct, item: DownloadItem) -> Path:
         item_name = _normalize_path_part(item["filename"], self._config.compatibility_mode)
+        # Join as strings and build a single Path, as every `/` on a Path creates
+        # and validates a new object.
+        return Path(os.path.join(self._product_dir(product), item_name))
+
+    def _product_dir(self, product: SyncProduct) -> str:
+        """Path to the product's directory, normalized once for all of its items."""
+
+        publishers_name = product.get("publisher", {}).get("name", "Others")
+        key = (publishers_name, product["name"])
+        try:
+            return self._product_dirs[key]
+        except KeyError:
+            pass
+
+        compatibility_mode = self._config.compatibility_mode
+        product_name = _normalize_path_part(product["name"], compatibility_mode)
         if self._config.omit_publisher:
-            return self._config.library_path / product_name / item_name
+            product_dir = os.path.join(self._library_dir, product_name)
         else:
-            return self._config.library_path / publishers_name / product_name / item_name
+            publishers_name = _normalize_path_part(publishers_name, compatibility_mode)
+            product_dir = os.path.join(self._library_dir, publishers_name, product_name)
+        self._product_dirs[key] = product_dir
+        return product_dir
 
 
+class _SyncCancelled(Exception):
+    """Raised in a worker to abandon its item when the sync is interrupted."""
+
+
+class _ChecksumCache:
+    """
+    MD5 checksums of local files kept between syncs, so only files whose modification
+    time or size changed since they were last hashed are read again.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._changed = False
+        self._seen: set[str] = set()
+        # Workers may still add checksums when an interrupted sync saves them
+        self._lock = threading.Lock()
+        self._checksums: dict[str, list[Any]] = {}
+        try:
+            with path.open() as f:
+                checksums = json.load(f)
+        except (OSError, ValueError):
+            return
+        # Valid JSON can still be anything, only a mapping of paths is a cache
+        if isinstance(checksums, dict):
+            self._checksums = checksums
+
+    def get(self, path: Path, stat: os.stat_result) -> str:
+        key = str(path)
+        self._seen.add(key)
+        mtime_size = [stat.st_mtime_ns, stat.st_size]
+        entry = self._checksums.get(key)
+        if entry and entry[:2] == mtime_size:
+            return entry[2]
+
+        checksum = _file_md5(path)
+        with self._lock:
+            self._checksums[key] = [*mtime_size, checksum]
+            self._changed = True
+        return checksum
+
+    def save(self, *, prune: bool = False) -> None:
+        """
+        Write checksums to the cache file. Pruning drops files not checked since loading,
+        so call it only after checking every file in the library.
+        """
+
+        with self._lock:
+            if prune and not self._seen.issuperset(self._checksums):
+                self._checksums = {
+                    key: entry for key, entry in self._checksums.items() if key in self._seen
+                }
+                self._changed = True
+            if not self._changed:
+                return
+            # Write to a temporary file first, so an interrupted save doesn't corrupt the cache
+            tmp_path = self._path.with_name(f"{self._path.name}.part")
+            with tmp_path.open("w") as f:
+                json.dump(self._checksums, f)
+            tmp_path.replace(self._path)
+            self._changed = False
+
+
+# Publishers' names repeat across many products, so normalize each of them only once
+@functools.lru_cache(maxsize=4096)
 def _normalize_path_part(part: str, compatibility_mode: bool) -> str:
     """
     Strip out unwanted characters in parts of the path to the downloaded file representing
@@ -198,32 +447,76 @@ def _normalize_path_part(part: str, compatibility_mode: bool) -> str:
     return part
 
 
+def _slim_product(product: Product) -> SyncProduct:
+    """
+    Copy only the product's fields needed to sync its items, so the rest of the API
+    response, including the list of files, is not kept alive for every item.
+    """
+
+    slim_product = SyncProduct(
+        name=product["name"],
+        orderProductId=product["orderProductId"],
+        fileLastModified=product["fileLastModified"],
+    )
+    if "publisher" in product:
+        slim_product["publisher"] = product["publisher"]
+    return slim_product
+
+
+# All items of a product share its modification date, so parse it only once
+@functools.lru_cache(maxsize=1024)
+def _timestamp(iso_datetime: str) -> float:
+    """Convert an ISO formatted date to a POSIX timestamp, treating naive dates as UTC."""
+
+    date = datetime.fromisoformat(iso_datetime)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def _file_md5(path: Path) -> str:
+    """Calculate MD5 checksum of a file reading it in chunks to keep memory usage low."""
+
+    with path.open("rb") as f:
+        if sys.version_info >= (3, 11):
+            # Reads the file into a reused buffer, without a Python call per chunk
+            return file_digest(f, md5).hexdigest()
+
+        checksum = md5()
+        while chunk := f.read(CHUNK_SIZE):
+            checksum.update(chunk)
+        return checksum.hexdigest()
+
+
 def _newest_checksum(item: DownloadItem) -> str | None:
     return max(
         item["checksums"] or [],
         default={"checksum": None},
-        key=lambda s: datetime.fromisoformat(s["checksumDate"]),
+        # The API formats all dates the same way, so comparing them as strings
+        # orders them by time without parsing every date.
+        key=itemgetter("checksumDate"),
     )["checksum"]
 
 
 class PathNormalizer:
     separator_drpg = " - "
-    multiple_drpg_separators = f"({separator_drpg})+"
+    invalid_characters_drpg = str.maketrans(dict.fromkeys('<>:"/\\|?*', separator_drpg))
+    multiple_drpg_separators = re.compile(f"({separator_drpg})+")
     multiple_whitespaces = re.compile(r"\s+")
     non_standard_characters = re.compile(r"[^a-zA-Z0-9.\s]")
 
     @classmethod
     def normalize_drivethrurpg_compatible(cls, part: str) -> str:
         separator = "_"
-        part = re.sub(cls.non_standard_characters, separator, part)
-        part = re.sub(cls.multiple_whitespaces, " ", part)
+        part = cls.non_standard_characters.sub(separator, part)
+        part = cls.multiple_whitespaces.sub(" ", part)
         return part
 
     @classmethod
     def normalize(cls, part: str) -> str:
-        separator = PathNormalizer.separator_drpg
+        separator = cls.separator_drpg
         part = html.unescape(part)
-        part = re.sub(r'[<>:"/\\|?*]', separator, part).strip(separator)
-        part = re.sub(PathNormalizer.multiple_drpg_separators, separator, part)
-        part = re.sub(PathNormalizer.multiple_whitespaces, " ", part)
+        part = part.translate(cls.invalid_characters_drpg).strip(separator)
+        part = cls.multiple_drpg_separators.sub(separator, part)
+        part = cls.multiple_whitespaces.sub(" ", part)
         return part
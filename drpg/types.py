@@ -25,6 +25,17 @@ class Publisher(TypedDict):
     name: str
 
 
+class _SyncProductOptional(TypedDict, total=False):
+    publisher: Publisher
+
+
+# Only the product's fields needed to sync its items
+class SyncProduct(_SyncProductOptional):
+    name: str
+    orderProductId: int
+    fileLastModified: str  # ISO format
+
+
 class DownloadItem(TypedDict):
     index: int
     filename: str
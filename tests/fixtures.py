@@ -1,17 +1,34 @@
+from typing import Any
+
+import respx
+
 from drpg.types import PrepareDownloadUrlResponse
 
+_COMPLETE = PrepareDownloadUrlResponse(
+    url="https://example.com/file.pdf",
+    status="Complete",
+)
+_PREPARING = PrepareDownloadUrlResponse(
+    url="https://example.com/file.pdf",
+    status="Preparing download...",
+)
+
 
 class PrepareDownloadUrlResponseFixture:
     @staticmethod
     def complete() -> PrepareDownloadUrlResponse:
-        return PrepareDownloadUrlResponse(
-            url="https://example.com/file.pdf",
-            status="Complete",
-        )
+        return _COMPLETE.copy()
 
     @staticmethod
     def preparing() -> PrepareDownloadUrlResponse:
-        return PrepareDownloadUrlResponse(
-            url="https://example.com/file.pdf",
-            status="Preparing download...",
-        )
+        return _PREPARING.copy()
+
+
+def module_respx_mock(**kwargs: Any) -> respx.MockRouter:
+    """
+    Router shared by all tests in a module, so httpx is patched only once.
+    Start it in the module's setUpModule and stop it in tearDownModule.
+    """
+
+    # Using "httpx" is a workaround for https://github.com/lundberg/respx/issues/277
+    return respx.mock(using="httpx", assert_all_called=False, **kwargs)
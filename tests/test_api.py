@@ -1,138 +1,202 @@
 import re
-from functools import partial
+from os import environ
+from threading import Event
 from unittest import TestCase, mock
 from urllib.parse import urlencode, urlparse
 
-import respx
-from httpx import Response
+from httpx import ConnectError, HTTPStatusError, ReadError, Request, Response
 
 from drpg import api
 
-from .fixtures import PrepareDownloadUrlResponseFixture
+from .fixtures import PrepareDownloadUrlResponseFixture, module_respx_mock
 
 _api_url = urlparse(api.DrpgApi.API_URL)
 api_base_url = f"{_api_url.scheme}://{_api_url.hostname}"
 
-# Workaround for https://github.com/lundberg/respx/issues/277
-tmp_respx_mock = partial(respx.mock, using="httpx")
+respx_mock = module_respx_mock(base_url=api_base_url)
 
 
-class DrpgApiTokenTest(TestCase):
+def setUpModule():
+    respx_mock.start()
+
+
+def tearDownModule():
+    respx_mock.stop()
+
+
+class DrpgApiTestCase(TestCase):
+    # A single client shared by all test cases, as building httpx.Client is expensive
+    client = api.DrpgApi("token")
+
     def setUp(self):
-        self.login_url = "api/vBeta/auth_key"
-        self.client = api.DrpgApi("token")
+        self.addCleanup(respx_mock.reset)
+        self.addCleanup(respx_mock.clear)
 
-    @tmp_respx_mock(base_url=api_base_url)
-    def test_login_valid_token(self, respx_mock):
-        content = {"token": "some-token", "refreshToken": "123", "refreshTokenTTL": 171235}
-        respx_mock.post(self.login_url).respond(200, json=content)
 
-        login_data = self.client.token()
-        self.assertEqual(login_data, content)
+class DrpgApiClientTest(TestCase):
+    def test_environment_proxies(self):
+        env = {"HTTPS_PROXY": "http://proxy.example.com:3128"}
+        with mock.patch.dict(environ, env):
+            client = api.DrpgApi("token")
+        self.assertTrue(client._client._mounts)
 
-    @tmp_respx_mock(base_url=api_base_url)
-    def test_login_invalid_token(self, respx_mock):
-        respx_mock.post(self.login_url).respond(401)
+    def test_http2_only(self):
+        pool = api.DrpgApi("token")._client._transport._pool
+        self.assertFalse(pool._http1)
+        self.assertTrue(pool._http2)
 
-        with self.assertRaises(AttributeError):
-            self.client.token()
 
+class IsTransientErrorTest(TestCase):
+    def test_errors(self):
+        request = Request("GET", api.DrpgApi.API_URL)
+        test_data = [
+            ["connection error", ConnectError("Refused", request=request), True],
+            ["read error", ReadError("Reset", request=request), True],
+            ["server error", HTTPStatusError("", request=request, response=Response(503)), True],
+            ["client error", HTTPStatusError("", request=request, response=Response(404)), False],
+        ]
 
-class DrpgApiCustomerProductsTest(TestCase):
-    def setUp(self):
-        url = "api/vBeta/order_products"
-        self.products_page = re.compile(f"{url}\\?.+$")
-        self.client = api.DrpgApi("token")
-
-    @tmp_respx_mock(base_url=api_base_url)
-    def test_one_page(self, respx_mock):
-        page_1_products = [{"name": "First Product"}]
-        respx_mock.get(self.products_page).mock(
-            side_effect=[
-                Response(200, json=page_1_products),
-                Response(200, json=[]),
-            ]
+        for name, error, expected in test_data:
+            with self.subTest(name):
+                self.assertEqual(api.is_transient_error(error), expected)
+
+
+page_1_products = [{"name": "First Product"}]
+page_2_products = [{"name": "Second Product"}]
+all_products = page_1_products + page_2_products
+
+# Responses are built once and reused, as their bodies are serialized on creation
+_PAGE_1_RESPONSE = Response(200, json=page_1_products)
+_PAGE_2_RESPONSE = Response(200, json=page_2_products)
+_LAST_PAGE_RESPONSE = Response(200, json=[])
+_PRODUCTS_PAGE_RE = re.compile(r"api/vBeta/order_products\?.+$")
+
+
+class DrpgApiCustomerProductsTest(DrpgApiTestCase):
+    def test_one_page(self):
+        respx_mock.get(_PRODUCTS_PAGE_RE).mock(
+            side_effect=[_PAGE_1_RESPONSE, _LAST_PAGE_RESPONSE],
         )
 
         products = self.client.customer_products()
-        self.assertEqual(list(products), page_1_products)
+        self.assertEqual(next(products), page_1_products[0])
+        self.assertRaises(StopIteration, next, products)
 
-    @tmp_respx_mock(base_url=api_base_url)
-    def test_multiple_pages(self, respx_mock):
-        page_1_products = [{"name": "First Product"}]
-        page_2_products = [{"name": "Second Product"}]
-        respx_mock.get(self.products_page).mock(
-            side_effect=[
-                Response(200, json=page_1_products),
-                Response(200, json=page_2_products),
-                Response(200, json=[]),
-            ]
+    def test_multiple_pages(self):
+        respx_mock.get(_PRODUCTS_PAGE_RE).mock(
+            side_effect=[_PAGE_1_RESPONSE, _PAGE_2_RESPONSE, _LAST_PAGE_RESPONSE],
         )
         products = self.client.customer_products()
-        self.assertEqual(list(products), page_1_products + page_2_products)
+        self.assertEqual(list(products), all_products)
 
+    def test_prefetches_next_page(self):
+        pages = [[{"name": "First Product"}], [{"name": "Second Product"}], []]
+        page_2_fetched = Event()
 
-class DrpgApiPrepareDownloadUrlTest(TestCase):
-    def setUp(self):
-        self.order_product_id = 123
-        params = urlencode({"siteId": 10, "index": 0, "getChecksums": 0})
-        self.prepare_download_url = (
-            f"/api/vBeta/order_products/{self.order_product_id}/prepare?{params}"
-        )
-        self.check_download_url = (
-            f"/api/vBeta/order_products/{self.order_product_id}/check?{params}"
+        def product_page(page, per_page):
+            if page == 2:
+                page_2_fetched.set()
+            return pages[page - 1]
+
+        with mock.patch.object(self.client, "_product_page", side_effect=product_page):
+            products = self.client.customer_products()
+            self.assertEqual(next(products), pages[0][0])
+            self.assertTrue(page_2_fetched.wait(timeout=1))
+            self.assertEqual(list(products), pages[1])
+
+    @mock.patch("drpg.api.sleep")
+    def test_retries_server_errors(self, sleep_mock):
+        respx_mock.get(_PRODUCTS_PAGE_RE).mock(
+            side_effect=[Response(503), Response(502), _PAGE_1_RESPONSE, _LAST_PAGE_RESPONSE],
         )
 
-        self.response_preparing = PrepareDownloadUrlResponseFixture.preparing()
-        self.response_ready = PrepareDownloadUrlResponseFixture.complete()
+        products = self.client.customer_products()
+        self.assertEqual(list(products), page_1_products)
+        self.assertEqual(sleep_mock.call_args_list, [mock.call(1), mock.call(2)])
 
-        self.client = api.DrpgApi("token")
+    @mock.patch("drpg.api.sleep")
+    def test_retries_connection_errors(self, sleep_mock):
+        respx_mock.get(_PRODUCTS_PAGE_RE).mock(
+            side_effect=[ConnectError("Connection refused"), _PAGE_1_RESPONSE, _LAST_PAGE_RESPONSE],
+        )
 
-    @tmp_respx_mock(base_url=api_base_url)
-    def test_immiediate_download_url(self, respx_mock):
+        products = self.client.customer_products()
+        self.assertEqual(list(products), page_1_products)
+        self.assertEqual(sleep_mock.call_args_list, [mock.call(1)])
+
+    @mock.patch("drpg.api.sleep")
+    def test_gives_up_after_retries(self, sleep_mock):
+        route = respx_mock.get(_PRODUCTS_PAGE_RE).respond(503, json=[])
+
+        self.client._product_page(1, 50)
+        self.assertEqual(route.call_count, api.DrpgApi.RETRIES + 1)
+        self.assertEqual(sleep_mock.call_count, api.DrpgApi.RETRIES)
+
+
+_PREPARE_DOWNLOAD_URL_PARAMS = urlencode({"siteId": 10, "index": 0, "getChecksums": 0})
+
+
+class DrpgApiPrepareDownloadUrlTest(DrpgApiTestCase):
+    order_product_id = 123
+    prepare_download_url = (
+        f"/api/vBeta/order_products/{order_product_id}/prepare?{_PREPARE_DOWNLOAD_URL_PARAMS}"
+    )
+    check_download_url = (
+        f"/api/vBeta/order_products/{order_product_id}/check?{_PREPARE_DOWNLOAD_URL_PARAMS}"
+    )
+    # Only read by the tests, so they can be shared
+    response_preparing = PrepareDownloadUrlResponseFixture.preparing()
+    response_ready = PrepareDownloadUrlResponseFixture.complete()
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Don't wait between polling for a download URL
+        sleep_patch = mock.patch("drpg.api.sleep")
+        sleep_patch.start()
+        cls.addClassCleanup(sleep_patch.stop)
+
+    def test_immiediate_download_url(self):
         respx_mock.get(self.prepare_download_url).respond(200, json=self.response_ready)
 
         file_data = self.client.prepare_download_url(self.order_product_id, 0)
         self.assertEqual(file_data, self.response_ready)
 
-    @mock.patch("drpg.api.sleep")
-    @tmp_respx_mock(base_url=api_base_url)
-    def test_wait_for_download_url(self, _, respx_mock):
+    def test_wait_for_download_url(self):
         respx_mock.get(self.prepare_download_url).respond(200, json=self.response_preparing)
         respx_mock.get(self.check_download_url).respond(200, json=self.response_ready)
 
         file_data = self.client.prepare_download_url(self.order_product_id, 0)
         self.assertEqual(file_data, self.response_ready)
 
-    @tmp_respx_mock(base_url=api_base_url)
-    def test_unsuccesful_response(self, respx_mock):
-        dummy_400_response = {"message": "Invalid product id"}
-        respx_mock.get(self.prepare_download_url).respond(400, json=dummy_400_response)
-
-        with self.assertRaises(self.client.PrepareDownloadUrlException) as cm:
-            self.client.prepare_download_url(self.order_product_id, 0)
-        self.assertTupleEqual(
-            cm.exception.args, (self.client.PrepareDownloadUrlException.REQUEST_FAILED,)
-        )
-
-    @tmp_respx_mock(base_url=api_base_url)
-    def test_unexpected_response_with_string_message(self, respx_mock):
-        dummy_unexpected_response = {"message": "Invalid product id"}
-        respx_mock.get(self.prepare_download_url).respond(200, json=dummy_unexpected_response)
-
-        with self.assertRaises(self.client.PrepareDownloadUrlException) as cm:
-            self.client.prepare_download_url(self.order_product_id, 0)
-        self.assertTupleEqual(
-            cm.exception.args, (self.client.PrepareDownloadUrlException.UNEXPECTED_RESPONSE,)
-        )
-
-    @tmp_respx_mock(base_url=api_base_url)
-    def test_unexpected_response_with_json_message(self, respx_mock):
-        dummy_unexpected_response = {"message": {"reason": "Invalid product id"}}
-        respx_mock.get(self.prepare_download_url).respond(200, json=dummy_unexpected_response)
-
-        with self.assertRaises(self.client.PrepareDownloadUrlException) as cm:
-            self.client.prepare_download_url(self.order_product_id, 0)
-        self.assertTupleEqual(
-            cm.exception.args, (self.client.PrepareDownloadUrlException.UNEXPECTED_RESPONSE,)
-        )
+    def test_unsuccessful_responses(self):
+        exception = self.client.PrepareDownloadUrlException
+        test_data = [
+            [
+                "unsuccessful response",
+                400,
+                {"message": "Invalid product id"},
+                exception.REQUEST_FAILED,
+            ],
+            [
+                "unexpected response with string message",
+                200,
+                {"message": "Invalid product id"},
+                exception.UNEXPECTED_RESPONSE,
+            ],
+            [
+                "unexpected response with json message",
+                200,
+                {"message": {"reason": "Invalid product id"}},
+                exception.UNEXPECTED_RESPONSE,
+            ],
+        ]
+        route = respx_mock.get(self.prepare_download_url)
+
+        for name, status_code, content, message in test_data:
+            with self.subTest(name):
+                route.respond(status_code, json=content)
+
+                with self.assertRaises(exception) as cm:
+                    self.client.prepare_download_url(self.order_product_id, 0)
+                self.assertTupleEqual(cm.exception.args, (message,))
@@ -0,0 +1,32 @@
+from unittest import TestCase
+
+from httpx import MockTransport, Response
+
+from drpg import api
+
+# Kept apart from test_api, as respx's router patches every httpx.Client while it runs.
+# A single canned response doesn't need the router, httpx's MockTransport is enough.
+
+
+class DrpgApiTokenTest(TestCase):
+    def setUp(self):
+        self.auth_key_response = Response(404)
+        self.client = api.DrpgApi("token", transport=MockTransport(self.handle_request))
+
+    def handle_request(self, request):
+        if request.url.path == "/api/vBeta/auth_key":
+            return self.auth_key_response
+        return Response(404)  # pragma: no cover
+
+    def test_login_valid_token(self):
+        content = {"token": "some-token", "refreshToken": "123", "refreshTokenTTL": 171235}
+        self.auth_key_response = Response(200, json=content)
+
+        login_data = self.client.token()
+        self.assertEqual(login_data, content)
+
+    def test_login_invalid_token(self):
+        self.auth_key_response = Response(401)
+
+        with self.assertRaises(AttributeError):
+            self.client.token()
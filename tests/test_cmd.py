@@ -23,6 +23,7 @@ class ParseCliTest(TestCase):
             "DRPG_LOG_LEVEL": "DEBUG",
             "DRPG_USE_CHECKSUMS": "true",
             "DRPG_VALIDATE": "true",
+            "DRPG_LINK_DUPLICATES": "true",
             "DRPG_DRY_RUN": "true",
             "DRPG_THREADS": "1",
             "DRPG_COMPATIBILITY_MODE": "true",
@@ -37,6 +38,7 @@ class ParseCliTest(TestCase):
         self.assertEqual(config.log_level, env["DRPG_LOG_LEVEL"])
         self.assertTrue(config.use_checksums)
         self.assertTrue(config.validate)
+        self.assertTrue(config.link_duplicates)
         self.assertTrue(config.dry_run)
         self.assertEqual(config.threads, int(env["DRPG_THREADS"]))
         self.assertTrue(config.compatibility_mode)
@@ -47,6 +49,15 @@ class ParseCliTest(TestCase):
         cmd._parse_cli(["--compatibility-mode", "--omit-publisher", "--token", "mock_token"])
         error_mock.assert_called()
 
+    @mock.patch("drpg.cmd.argparse.ArgumentParser.error")
+    def test_link_duplicates_requires_validate(self, error_mock):
+        cmd._parse_cli(["--link-duplicates", "--token", "mock_token"])
+        error_mock.assert_called_once_with("--link-duplicates requires --validate")
+
+        error_mock.reset_mock()
+        cmd._parse_cli(["--link-duplicates", "--validate", "--token", "mock_token"])
+        error_mock.assert_not_called()
+
 
 class SignalHandlerTest(TestCase):
     @mock.patch("drpg.cmd.sys.exit")
@@ -72,13 +83,11 @@ class SetHttpLogLevel(TestCase):
 
 
 class DefaultDirTest:
-    def setUp(self):
-        self.platform_system = mock.patch(
-            "drpg.cmd.platform.system", return_value=self.SYSTEM
-        ).start()
-
-    def tearDown(self):
-        self.platform_system.stop()
+    @classmethod
+    def setUpClass(cls):
+        platform_system = mock.patch("drpg.cmd.platform.system", return_value=cls.SYSTEM)
+        platform_system.start()
+        cls.addClassCleanup(platform_system.stop)
 
 
 class LinuxDefaultDirTest(DefaultDirTest, TestCase):
@@ -87,30 +96,36 @@ class LinuxDefaultDirTest(DefaultDirTest, TestCase):
     DOCS_DIR_FALLBACK = "$HOME/Documents"
     XDG_USER_DIRS_FILE = mock.mock_open(read_data=f'XDG_DOCUMENTS_DIR="{DOCS_DIR}"')
 
-    @mock.patch("drpg.cmd.open", XDG_USER_DIRS_FILE)
     def test_xdg_config_home(self):
-        with self.subTest("Default XDG_CONFIG_HOME"):
-            env = {"XDG_CONFIG_HOME": ""}
-            with mock.patch.dict("drpg.cmd.environ", env, clear=True):
-                default_dir = cmd._default_dir()
-            self.assertTrue(default_dir.relative_to(self.DOCS_DIR))
-
-        with self.subTest("Custom XDG_CONFIG_HOME"):
-            env = {"XDG_CONFIG_HOME": "$HOME/.config/xdg"}
-            with mock.patch.dict("drpg.cmd.environ", env, clear=True):
-                default_dir = cmd._default_dir()
-            self.assertTrue(default_dir.relative_to(self.DOCS_DIR))
+        test_data = [
+            ["Default XDG_CONFIG_HOME", ""],
+            ["Custom XDG_CONFIG_HOME", "$HOME/.config/xdg"],
+        ]
 
-    def test_xdg_config_user_dirs(self):
-        with self.subTest("The user-dirs.dirs config file exists"):
-            with mock.patch("drpg.cmd.open", self.XDG_USER_DIRS_FILE):
-                default_dir = cmd._default_dir()
-            self.assertTrue(default_dir.relative_to(expandvars(self.DOCS_DIR)))
+        for name, xdg_config_home in test_data:
+            env = {"XDG_CONFIG_HOME": xdg_config_home}
+            with self.subTest(name):
+                default_dir = cmd._default_dir(env=env, opener=self.XDG_USER_DIRS_FILE)
+                self.assertTrue(default_dir.relative_to(expandvars(self.DOCS_DIR)))
 
-        with self.subTest("The user-dirs.dirs config file does not exist"):
-            with mock.patch("drpg.cmd.open", side_effect=FileNotFoundError):
-                default_dir = cmd._default_dir()
-            self.assertTrue(default_dir.relative_to(expandvars(self.DOCS_DIR_FALLBACK)))
+    def test_xdg_config_user_dirs(self):
+        test_data = [
+            [
+                "The user-dirs.dirs config file exists",
+                self.XDG_USER_DIRS_FILE,
+                self.DOCS_DIR,
+            ],
+            [
+                "The user-dirs.dirs config file does not exist",
+                mock.Mock(side_effect=FileNotFoundError),
+                self.DOCS_DIR_FALLBACK,
+            ],
+        ]
+
+        for name, opener, docs_dir in test_data:
+            with self.subTest(name):
+                default_dir = cmd._default_dir(env={}, opener=opener)
+                self.assertTrue(default_dir.relative_to(expandvars(docs_dir)))
 
 
 class WindowsDefaultDirTest(DefaultDirTest, TestCase):
@@ -129,9 +144,13 @@ class MacDefaultDirTest(DefaultDirTest, TestCase):
         self.assertEqual(default_dir.parent, Path.cwd())
 
 
+SECRET = "123456789012345"
+MATCHING_URL = URL(f"https://example.org/?test=1&applicationKey={SECRET}&dummy=max")
+NOT_MATCHING_URL = URL(f"https://example.org/?test=1&secret={SECRET}&dummy=max")
+
+
 class ApplicationKeyFilterTest(TestCase):
     def test_matching_record(self):
-        secret = "123456789012345"
         record = logging.LogRecord(
             name="httpx",
             level=logging.INFO,
@@ -140,18 +159,17 @@ class ApplicationKeyFilterTest(TestCase):
             msg="Http request: %s %s %s",
             args=(
                 "POST",
-                URL(f"https://example.org/?test=1&applicationKey={secret}&dummy=max"),
+                MATCHING_URL,
                 "irrelevant",
             ),
             exc_info=None,
         )
 
-        self.assertIn(secret, record.getMessage())
+        self.assertIn(SECRET, record.getMessage())
         self.assertTrue(cmd.application_key_filter(record))
-        self.assertNotIn(secret, record.getMessage())
+        self.assertNotIn(SECRET, record.getMessage())
 
     def test_not_matching_record(self):
-        secret = "123456789012345"
         record = logging.LogRecord(
             name="httpx",
             level=logging.INFO,
@@ -160,15 +178,15 @@ class ApplicationKeyFilterTest(TestCase):
             msg="Http request: %s %s %s",
             args=(
                 "POST",
-                URL(f"https://example.org/?test=1&secret={secret}&dummy=max"),
+                NOT_MATCHING_URL,
                 "irrelevant",
             ),
             exc_info=None,
         )
 
-        self.assertIn(secret, record.getMessage())
+        self.assertIn(SECRET, record.getMessage())
         self.assertTrue(cmd.application_key_filter(record))
-        self.assertIn(secret, record.getMessage())
+        self.assertIn(SECRET, record.getMessage())
 
     def test_silent_exception(self):
         record = logging.LogRecord(
@@ -1,19 +1,22 @@
+import json
 import string
 from datetime import datetime, timedelta
 from functools import partial
 from hashlib import md5
+from io import BytesIO
 from os import stat_result
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Event
 from unittest import TestCase, mock
 
-import respx
-from httpx import HTTPError
+from httpx import HTTPError, ReadError, Response
 
 import drpg.sync
 from drpg import types
 from drpg.api import DrpgApi
 
-from .fixtures import PrepareDownloadUrlResponseFixture
+from .fixtures import PrepareDownloadUrlResponseFixture, module_respx_mock
 
 
 class dummy_config:
@@ -25,9 +28,26 @@ class dummy_config:
     threads = 5
     compatibility_mode = False
     omit_publisher = False
+    link_duplicates = False
 
 
-PathMock = partial(mock.Mock, spec=Path)
+# Path's attributes used by the sync. Unlike spec=Path, a short list of names
+# doesn't make every new mock introspect the whole Path class.
+PATH_SPEC = ["mkdir", "name", "open", "parent", "replace", "stat", "unlink", "with_name"]
+PathMock = partial(mock.Mock, spec=PATH_SPEC)
+
+# Tests don't depend on the actual date of a checksum
+CHECKSUM_DATE = datetime(2024, 1, 1).isoformat()
+
+respx_mock = module_respx_mock()
+
+
+def setUpModule():
+    respx_mock.start()
+
+
+def tearDownModule():
+    respx_mock.stop()
 
 
 class SuppressErrorsTest(TestCase):
@@ -47,40 +67,60 @@ class SuppressErrorsTest(TestCase):
                 logger.exception.assert_called_once()
 
 
+@mock.patch("drpg.DrpgSync._file_path")
 class DrpgSyncNeedDownloadTest(TestCase):
     new_date = datetime.now()
     old_date = new_date - timedelta(days=100)
     file_content = b"some file content"
+    file_md5 = md5(file_content).hexdigest()
 
     no_file_kwargs = {
-        "exists.return_value": False,
-        "read_bytes.side_effect": FileNotFoundError,
+        "open.side_effect": FileNotFoundError,
         "stat.side_effect": FileNotFoundError,
     }
     old_file_kwargs = {
-        "exists.return_value": True,
-        "read_bytes.return_value": file_content,
+        "open.side_effect": lambda *_: BytesIO(DrpgSyncNeedDownloadTest.file_content),
         "stat.return_value": mock.Mock(spec=stat_result, st_mtime=old_date.timestamp()),
     }
     new_file_kwargs = {
-        "exists.return_value": True,
-        "read_bytes.return_value": file_content,
+        "open.side_effect": lambda *_: BytesIO(DrpgSyncNeedDownloadTest.file_content),
         "stat.return_value": mock.Mock(spec=stat_result, st_mtime=new_date.timestamp()),
     }
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Tests only read these mocks, so they are built once and reset between tests
+        cls.no_file = PathMock(**cls.no_file_kwargs)
+        cls.old_file = PathMock(**cls.old_file_kwargs)
+        cls.new_file = PathMock(**cls.new_file_kwargs)
+
     def setUp(self):
-        self.sync = drpg.DrpgSync(dummy_config)
+        for path in (self.no_file, self.old_file, self.new_file):
+            path.reset_mock()
+        # Tests change the config, use an instance to not leak it to other tests
+        self.sync = drpg.DrpgSync(dummy_config())
 
-    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock(**no_file_kwargs))
-    def test_no_local_file(self, _):
+    def test_no_local_file(self, file_path):
+        file_path.return_value = self.no_file
         item = self.dummy_item(self.old_date)
         product = self.dummy_product(item)
 
         need = self.sync._need_download(product, item)
         self.assertTrue(need)
 
-    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock(**old_file_kwargs))
-    def test_local_last_modified_older(self, _):
+    def test_local_path_not_accessible(self, file_path):
+        item = self.dummy_item(self.old_date)
+        product = self.dummy_product(item)
+
+        for error in (NotADirectoryError, OSError(40, "Too many levels of symbolic links")):
+            with self.subTest(error=error):
+                file_path.return_value = PathMock(**{"stat.side_effect": error})
+                need = self.sync._need_download(product, item)
+                self.assertTrue(need)
+
+    def test_local_last_modified_older(self, file_path):
+        file_path.return_value = self.old_file
         item = self.dummy_item(self.new_date)
         product = self.dummy_product(item)
         product["fileLastModified"] = datetime.now().isoformat()
@@ -88,47 +128,45 @@ class DrpgSyncNeedDownloadTest(TestCase):
         need = self.sync._need_download(product, item)
         self.assertTrue(need)
 
-    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock(**new_file_kwargs))
-    def test_local_last_modified_newer(self, _):
+    def test_local_last_modified_newer(self, file_path):
+        file_path.return_value = self.new_file
         item = self.dummy_item(self.old_date)
         product = self.dummy_product(item)
 
         need = self.sync._need_download(product, item)
         self.assertFalse(need)
 
-    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock(**new_file_kwargs))
-    def test_md5_check(self, _):
-        self.sync._config.use_checksums = True
+    def test_md5_check(self, file_path):
+        self.sync = self.checksums_sync()
 
-        with self.subTest("same md5"):
-            item = self.dummy_item(self.old_date)
-            product = self.dummy_product(item)
-
-            need = self.sync._need_download(product, item)
-            self.assertFalse(need)
-
-        with self.subTest("different md5"):
-            item = self.dummy_item(self.old_date)
-            item["checksums"][0]["checksum"] += "not matching"
-            product = self.dummy_product(item)
+        item = self.dummy_item(self.old_date)
+        product = self.dummy_product(item)
+        checksum = item["checksums"][0]
 
-            need = self.sync._need_download(product, item)
-            self.assertTrue(need)
+        test_data = [
+            ["same md5", [checksum], False, True],
+            ["different md5", [{**checksum, "checksum": "not matching"}], True, True],
+            ["remote file has no checksum", [], False, False],
+        ]
 
-        with self.subTest("remote file has no checksum"):
-            item = self.dummy_item(self.old_date)
-            item["checksums"] = []
-            product = self.dummy_product(item)
+        for name, checksums, expected, hashed in test_data:
+            with self.subTest(name):
+                # A new file for every case, so its checksum is not cached
+                path = file_path.return_value = PathMock(**self.new_file_kwargs)
+                need = self.sync._need_download(product, {**item, "checksums": checksums})
+                self.assertEqual(need, expected)
+                self.assertEqual(path.open.called, hashed)
 
-            need = self.sync._need_download(product, item)
-            self.assertFalse(need)
+    def checksums_sync(self):
+        config = dummy_config()
+        config.use_checksums = True
+        return drpg.DrpgSync(config)
 
     def dummy_item(self, date):
-        file_md5 = md5(self.file_content).hexdigest()
         return types.DownloadItem(
             index=0,
             filename="file.pdf",
-            checksums=[types.Checksum(checksum=file_md5, checksumDate=_checksum_date_now())],
+            checksums=[types.Checksum(checksum=self.file_md5, checksumDate=CHECKSUM_DATE)],
         )
 
     def dummy_product(self, file):
@@ -182,16 +220,41 @@ class DrpgSyncFilePathTest(TestCase):
         path = drpg.DrpgSync(config)._file_path(product, item)
         self.assertIn(publisher, str(path))
 
+    def test_normalizes_product_dir_once(self):
+        product = {
+            "name": "Rulebook - 2. ed",
+            "publisher": {"name": "Unit Publishing"},
+        }
+        sync = drpg.DrpgSync(dummy_config)
+
+        with mock.patch(
+            "drpg.sync._normalize_path_part", side_effect=drpg.sync._normalize_path_part
+        ) as normalize_mock:
+            first = sync._file_path(product, {"filename": "first.pdf"})
+            second = sync._file_path(product, {"filename": "second.pdf"})
+
+        self.assertEqual(first.parent, second.parent)
+        # Publisher's and product's names once, plus each of the filenames
+        self.assertEqual(normalize_mock.call_count, 4)
+
 
 class DrpgSyncProcessItemTest(TestCase):
     download_url = PrepareDownloadUrlResponseFixture.complete()
     content = b"content"
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Don't wait between retried downloads
+        sleep = mock.patch("drpg.sync.sleep")
+        cls.sleep = sleep.start()
+        cls.addClassCleanup(sleep.stop)
+
     def setUp(self):
         self.item = types.DownloadItem(
             index=0,
             filename="test.pdf",
-            checksums=[types.Checksum(checksum="md5", checksumDate=_checksum_date_now())],
+            checksums=[types.Checksum(checksum="md5", checksumDate=CHECKSUM_DATE)],
         )
         self.product = types.Product(
             productId="test-product",
@@ -203,19 +266,179 @@ class DrpgSyncProcessItemTest(TestCase):
         )
         self.sync = drpg.DrpgSync(dummy_config)
 
+        respx_mock.get(self.download_url["url"]).respond(200, content=self.content)
+        self.addCleanup(respx_mock.reset)
+        self.addCleanup(respx_mock.clear)
+        self.sleep.reset_mock()
+
     @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock())
     @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
-    @respx.mock(base_url=DrpgApi.API_URL, using="httpx")
-    def test_writes_to_file(self, _, file_path, respx_mock):
-        respx_mock.get(self.download_url["url"]).respond(200, content=self.content)
+    def test_writes_to_file(self, _, file_path):
+        path = file_path.return_value
+        path.name = "test.pdf"
+        type(path).parent = mock.PropertyMock(return_value=PathMock())
+        download_path = path.with_name.return_value
+        download_path.open = mock.mock_open()
+
+        self.sync._process_item(self.product, self.item)
+
+        path.parent.mkdir.assert_called_once_with(parents=True, exist_ok=True)
+        path.with_name.assert_called_once_with("test.pdf.part")
+        download_path.open.assert_called_once_with("wb")
+        download_path.open.return_value.write.assert_called_once_with(self.content)
+        download_path.replace.assert_called_once_with(path)
 
+    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock())
+    @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
+    def test_creates_directory_once(self, _, file_path):
         path = file_path.return_value
         type(path).parent = mock.PropertyMock(return_value=PathMock())
+        path.with_name.return_value.open = mock.mock_open()
 
+        other_item = {**self.item, "filename": "other.pdf", "checksums": []}
         self.sync._process_item(self.product, self.item)
+        self.sync._process_item(self.product, other_item)
 
         path.parent.mkdir.assert_called_once_with(parents=True, exist_ok=True)
-        path.write_bytes.assert_called_once_with(self.content)
+
+    @mock.patch("drpg.sync.os.link")
+    @mock.patch("drpg.DrpgSync._file_path")
+    @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
+    def test_links_same_content(self, prepare_download_url, file_path, link):
+        first_path, second_path = file_path.side_effect = [PathMock(), PathMock()]
+        first_path.with_name.return_value.open = mock.mock_open()
+        bundle = {**self.product, "name": "Test bundle"}
+
+        sync = self.linking_sync()
+        sync._process_item(self.product, self.item)
+        sync._process_item(bundle, self.item)
+
+        prepare_download_url.assert_called_once()
+        link_path = second_path.with_name.return_value
+        link.assert_called_once_with(first_path, link_path)
+        link_path.replace.assert_called_once_with(second_path)
+
+    @mock.patch("drpg.sync.os.link")
+    @mock.patch("drpg.DrpgSync._file_path")
+    @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
+    def test_no_links(self, prepare_download_url, file_path, link):
+        self.item["checksums"][0]["checksum"] = md5(self.content).hexdigest()
+        bundle = {**self.product, "name": "Test bundle"}
+        test_data = [
+            ["links are not enabled", {"link_duplicates": False, "validate": True}],
+            ["downloads are not validated", {"link_duplicates": True, "validate": False}],
+        ]
+
+        for name, config_values in test_data:
+            with self.subTest(name):
+                prepare_download_url.reset_mock()
+                paths = file_path.side_effect = [PathMock(), PathMock()]
+                for path in paths:
+                    path.with_name.return_value.open = mock.mock_open()
+                config = dummy_config()
+                vars(config).update(config_values)
+
+                sync = drpg.DrpgSync(config)
+                sync._process_item(self.product, self.item)
+                sync._process_item(bundle, self.item)
+
+                self.assertEqual(prepare_download_url.call_count, 2)
+                link.assert_not_called()
+
+    @mock.patch("drpg.sync.os.link", side_effect=OSError)
+    @mock.patch("drpg.DrpgSync._file_path")
+    @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
+    def test_downloads_when_link_fails(self, prepare_download_url, file_path, _):
+        paths = file_path.side_effect = [PathMock(), PathMock()]
+        for path in paths:
+            path.with_name.return_value.open = mock.mock_open()
+        bundle = {**self.product, "name": "Test bundle"}
+
+        sync = self.linking_sync()
+        sync._process_item(self.product, self.item)
+        sync._process_item(bundle, self.item)
+
+        self.assertEqual(prepare_download_url.call_count, 2)
+        paths[1].with_name.return_value.replace.assert_called_once_with(paths[1])
+
+    @mock.patch("drpg.sync.logger")
+    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock())
+    @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
+    def test_removes_partial_download(self, _, file_path, logger):
+        respx_mock.get(self.download_url["url"]).mock(side_effect=ReadError)
+        path = file_path.return_value
+        download_path = path.with_name.return_value
+        download_path.open = mock.mock_open()
+
+        self.sync._process_item(self.product, self.item)
+
+        logger.exception.assert_called_once()
+        download_path.unlink.assert_called_with(missing_ok=True)
+        download_path.replace.assert_not_called()
+
+    @mock.patch("drpg.sync.logger")
+    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock())
+    @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
+    def test_removes_partial_download_when_replace_fails(self, _, file_path, logger):
+        respx_mock.get(self.download_url["url"]).mock(
+            return_value=Response(200, content=self.content)
+        )
+        path = file_path.return_value
+        download_path = path.with_name.return_value
+        download_path.open = mock.mock_open()
+        download_path.replace.side_effect = PermissionError
+
+        self.sync._process_item(self.product, self.item)
+
+        logger.exception.assert_called_once()
+        download_path.unlink.assert_called_once_with(missing_ok=True)
+
+    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock())
+    @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
+    def test_cancelled_download(self, _, file_path):
+        respx_mock.get(self.download_url["url"]).respond(200, content=self.content)
+        download_path = file_path.return_value.with_name.return_value
+        download_path.open = mock.mock_open()
+        self.sync._cancel.set()
+
+        with self.assertRaises(drpg.sync._SyncCancelled):
+            self.sync._process_item(self.product, self.item)
+
+        download_path.open.return_value.write.assert_not_called()
+        download_path.unlink.assert_called_once_with(missing_ok=True)
+        download_path.replace.assert_not_called()
+
+    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock())
+    @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
+    def test_retries_transient_download_errors(self, _, file_path):
+        route = respx_mock.get(self.download_url["url"]).mock(
+            side_effect=[ReadError("Reset"), Response(503), Response(200, content=self.content)]
+        )
+        path = file_path.return_value
+        download_path = path.with_name.return_value
+        download_path.open = mock.mock_open()
+
+        self.sync._process_item(self.product, self.item)
+
+        self.assertEqual(route.call_count, 3)
+        self.assertEqual(self.sleep.call_args_list, [mock.call(1), mock.call(2)])
+        download_path.open.return_value.write.assert_called_once_with(self.content)
+        download_path.replace.assert_called_once_with(path)
+
+    @mock.patch("drpg.sync.logger")
+    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock())
+    @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
+    def test_client_error_not_retried(self, _, file_path, logger):
+        route = respx_mock.get(self.download_url["url"]).respond(404)
+        download_path = file_path.return_value.with_name.return_value
+        download_path.open = mock.mock_open()
+
+        self.sync._process_item(self.product, self.item)
+
+        self.assertEqual(route.call_count, 1)
+        logger.exception.assert_called_once()
+        download_path.open.assert_not_called()
+        download_path.replace.assert_not_called()
 
     @mock.patch("drpg.sync.logger")
     @mock.patch("drpg.api.DrpgApi.prepare_download_url")
@@ -248,12 +471,44 @@ class DrpgSyncProcessItemTest(TestCase):
     @mock.patch("drpg.sync.logger")
     @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock())
     @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
-    def test_invalid_download(self, _prepare_download_url, _file_path, logger):
+    def test_invalid_download(self, _prepare_download_url, file_path, logger):
+        download_path = file_path.return_value.with_name.return_value
+        download_path.open = mock.mock_open()
         config = dummy_config()
         config.validate = True
         drpg.DrpgSync(config)._process_item(self.product, self.item)
         logger.error.assert_called_once()
         self.assertIn("Invalid checksum", logger.error.call_args.args[0])
+        self.assertEqual(respx_mock.calls.call_count, drpg.sync.DOWNLOAD_ATTEMPTS)
+        download_path.unlink.assert_called_once()
+        download_path.replace.assert_not_called()
+
+    @mock.patch("drpg.sync.logger")
+    @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock())
+    @mock.patch("drpg.api.DrpgApi.prepare_download_url", return_value=download_url)
+    def test_checksum_mismatch_retries(self, _prepare_download_url, file_path, logger):
+        respx_mock.get(self.download_url["url"]).mock(
+            side_effect=[
+                Response(200, content=b"corrupted"),
+                Response(200, content=self.content),
+            ]
+        )
+        self.item["checksums"][0]["checksum"] = md5(self.content).hexdigest()
+        path = file_path.return_value
+        download_path = path.with_name.return_value
+        download_path.open = mock.mock_open()
+        config = dummy_config()
+        config.validate = True
+        drpg.DrpgSync(config)._process_item(self.product, self.item)
+        logger.error.assert_not_called()
+        download_path.replace.assert_called_once_with(path)
+
+    def linking_sync(self):
+        self.item["checksums"][0]["checksum"] = md5(self.content).hexdigest()
+        config = dummy_config()
+        config.link_duplicates = True
+        config.validate = True
+        return drpg.DrpgSync(config)
 
     @mock.patch("drpg.sync.logger")
     @mock.patch("drpg.DrpgSync._file_path", return_value=PathMock())
@@ -282,6 +537,154 @@ class DrpgSyncTest(TestCase):
         self.sync.sync()
         self.assertEqual(process_item_mock.call_count, files_count * products_count)
 
+    @mock.patch("drpg.api.DrpgApi.token", return_value={"access_token": "t"})
+    @mock.patch("drpg.DrpgSync._need_download", return_value=False)
+    @mock.patch("drpg.api.DrpgApi.customer_products")
+    @mock.patch("drpg.DrpgSync._process_item")
+    def test_skips_up_to_date_items(self, process_item_mock, customer_products_mock, *_):
+        customer_products_mock.return_value = [self.dummy_product("Rule Book", 5)]
+        self.sync.sync()
+        process_item_mock.assert_not_called()
+
+    @mock.patch("drpg.sync.logger")
+    @mock.patch("drpg.api.DrpgApi.token", return_value={"access_token": "t"})
+    @mock.patch("drpg.DrpgSync._need_download", side_effect=[PermissionError, True, True])
+    @mock.patch("drpg.api.DrpgApi.customer_products")
+    @mock.patch("drpg.DrpgSync._process_item")
+    def test_item_error_does_not_stop_sync(
+        self, process_item_mock, customer_products_mock, _, __, logger
+    ):
+        customer_products_mock.return_value = [self.dummy_product("Rule Book", 3)]
+        self.sync.sync()
+
+        logger.exception.assert_called_once()
+        self.assertEqual(process_item_mock.call_count, 2)
+
+    @mock.patch("drpg.api.DrpgApi.token", return_value={"access_token": "t"})
+    @mock.patch("drpg.DrpgSync._need_download", return_value=True)
+    @mock.patch("drpg.api.DrpgApi.customer_products")
+    @mock.patch("drpg.DrpgSync._process_item")
+    def test_products_error_while_syncing(self, _, customer_products_mock, *__):
+        def customer_products():
+            yield self.dummy_product("Rule Book", 1)
+            raise HTTPError("Next page failed")
+
+        # Products are fetched while items are synced, errors still stop the sync
+        customer_products_mock.side_effect = customer_products
+        with self.assertRaises(HTTPError):
+            self.sync.sync()
+
+    @mock.patch("drpg.api.DrpgApi.token", return_value={"access_token": "t"})
+    @mock.patch("drpg.api.DrpgApi.customer_products")
+    @mock.patch("drpg.sync.ThreadPool")
+    def test_thread_pool_used(self, thread_pool_mock, customer_products_mock, _):
+        customer_products_mock.return_value = [self.dummy_product("Rule Book", 2)]
+        self.sync.sync()
+
+        thread_pool_mock.assert_called_once_with(dummy_config.threads)
+        pool = thread_pool_mock.return_value
+        self.assertEqual(pool.apply_async.call_count, 2)
+        sync_item, _ = pool.apply_async.call_args.args
+        self.assertEqual(sync_item, self.sync._sync_item)
+        pool.join.assert_called_once()
+        self.assertTrue(self.sync._http.is_closed)
+
+    @mock.patch("drpg.api.DrpgApi.token", return_value={"access_token": "t"})
+    @mock.patch("drpg.DrpgSync._need_download")
+    @mock.patch("drpg.api.DrpgApi.customer_products")
+    def test_interrupt_does_not_wait_for_items(self, customer_products_mock, need_download, _):
+        started, release = Event(), Event()
+        self.addCleanup(release.set)
+
+        def slow_need_download(product, item):
+            started.set()
+            release.wait(5)
+            return False
+
+        def interrupted_products():
+            yield self.dummy_product("Rule Book", 1)
+            started.wait(5)
+            raise KeyboardInterrupt
+
+        need_download.side_effect = slow_need_download
+        customer_products_mock.side_effect = interrupted_products
+        with self.assertRaises(KeyboardInterrupt):
+            self.sync.sync()
+
+        self.assertTrue(self.sync._cancel.is_set())
+        self.assertFalse(release.is_set())
+
+    @mock.patch("drpg.DrpgSync._need_download")
+    def test_cancelled_item_not_synced(self, need_download):
+        self.sync._cancel.set()
+        self.sync._sync_item((self.dummy_product("Rule Book", 1), mock.Mock()))
+        need_download.assert_not_called()
+
+    def test_no_checksums_cache_without_use_checksums(self):
+        self.assertIsNone(self.sync._checksums)
+
+    @mock.patch("drpg.api.DrpgApi.token", return_value={"access_token": "t"})
+    @mock.patch("drpg.DrpgSync._need_download", return_value=False)
+    @mock.patch("drpg.api.DrpgApi.customer_products")
+    @mock.patch("drpg.sync._ChecksumCache")
+    def test_saves_checksums(self, checksum_cache_mock, customer_products_mock, *_):
+        def interrupted_products():
+            yield self.dummy_product("Rule Book", 1)
+            raise HTTPError("Next page failed")
+
+        config = dummy_config()
+        config.use_checksums = True
+        test_data = [
+            ["completed sync prunes checksums", lambda: iter([]), True],
+            ["interrupted sync keeps checksums", interrupted_products, False],
+        ]
+
+        for name, customer_products, prune in test_data:
+            with self.subTest(name):
+                checksum_cache_mock.return_value.save.reset_mock()
+                customer_products_mock.side_effect = customer_products
+                try:
+                    drpg.DrpgSync(config).sync()
+                except HTTPError:
+                    pass
+                checksum_cache_mock.return_value.save.assert_called_once_with(prune=prune)
+
+    @mock.patch("drpg.sync.logger")
+    @mock.patch("drpg.api.DrpgApi.token", return_value={"access_token": "t"})
+    @mock.patch("drpg.api.DrpgApi.customer_products", return_value=[])
+    @mock.patch("drpg.sync._ChecksumCache")
+    def test_checksums_save_error(self, checksum_cache_mock, _, __, logger):
+        checksum_cache_mock.return_value.save.side_effect = PermissionError
+        config = dummy_config()
+        config.use_checksums = True
+
+        try:
+            drpg.DrpgSync(config).sync()
+        except PermissionError as e:  # pragma: no cover
+            self.fail(e)
+        logger.warning.assert_called_once()
+
+    @mock.patch("drpg.api.DrpgApi.token", return_value={"access_token": "t"})
+    @mock.patch("drpg.DrpgSync._need_download", return_value=True)
+    @mock.patch("drpg.api.DrpgApi.customer_products")
+    @mock.patch("drpg.DrpgSync._process_item")
+    def test_passes_slim_product(self, process_item_mock, customer_products_mock, *_):
+        product = self.dummy_product("Rule Book", 1)
+        customer_products_mock.return_value = [product]
+        self.sync.sync()
+
+        slim_product, item = process_item_mock.call_args.args
+        self.assertIs(item, product["files"][0])
+        self.assertEqual(
+            slim_product,
+            {
+                "name": product["name"],
+                "publisher": product["publisher"],
+                "orderProductId": product["orderProductId"],
+                "fileLastModified": product["fileLastModified"],
+            },
+        )
+
     def dummy_product(self, name, files_count):
         return types.Product(
             productId="test-product",
@@ -303,6 +706,16 @@ class EscapePathTest(TestCase):
             self.assertEqual(drpg.sync._normalize_path_part(name, False), "some name")
             self.assertEqual(drpg.sync._normalize_path_part(name, True), "some name")
 
+    def test_normalize_path_part_cached(self):
+        drpg.sync._normalize_path_part.cache_clear()
+        self.addCleanup(drpg.sync._normalize_path_part.cache_clear)
+
+        first = drpg.sync._normalize_path_part("Some: Publisher", False)
+        second = drpg.sync._normalize_path_part("Some: Publisher", False)
+
+        self.assertEqual(first, second)
+        self.assertEqual(drpg.sync._normalize_path_part.cache_info().hits, 1)
+
     def test_normalize_path_part(self):
         """
         Make sure that filenames and directory names use UTF-8 character instead of
@@ -367,11 +780,118 @@ class EscapePathTest(TestCase):
                 )
 
 
+class FileMd5Test(TestCase):
+    def test_reads_in_chunks(self):
+        content = b"0123456789"
+        path = PathMock(**{"open.return_value": BytesIO(content)})
+
+        with mock.patch("drpg.sync.CHUNK_SIZE", 3):
+            checksum = drpg.sync._file_md5(path)
+
+        self.assertEqual(checksum, md5(content).hexdigest())
+        path.open.assert_called_once_with("rb")
+
+
+class ChecksumCacheTest(TestCase):
+    content = b"some file content"
+
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache_path = Path(tmp_dir.name, drpg.sync.CHECKSUMS_FILE)
+        self.file_path = Path(tmp_dir.name, "file.pdf")
+        self.file_path.write_bytes(self.content)
+
+    def test_hashes_file_once(self):
+        cache = drpg.sync._ChecksumCache(self.cache_path)
+        stat = self.file_path.stat()
+
+        with mock.patch("drpg.sync._file_md5", side_effect=drpg.sync._file_md5) as file_md5:
+            first = cache.get(self.file_path, stat)
+            second = cache.get(self.file_path, stat)
+
+        self.assertEqual(first, md5(self.content).hexdigest())
+        self.assertEqual(second, first)
+        file_md5.assert_called_once_with(self.file_path)
+
+    def test_hashes_changed_file(self):
+        cache = drpg.sync._ChecksumCache(self.cache_path)
+        cache.get(self.file_path, self.file_path.stat())
+        self.file_path.write_bytes(b"new content")
+
+        checksum = cache.get(self.file_path, self.file_path.stat())
+        self.assertEqual(checksum, md5(b"new content").hexdigest())
+
+    def test_save_and_load(self):
+        cache = drpg.sync._ChecksumCache(self.cache_path)
+        checksum = cache.get(self.file_path, self.file_path.stat())
+        cache.save()
+
+        with mock.patch("drpg.sync._file_md5") as file_md5:
+            loaded = drpg.sync._ChecksumCache(self.cache_path)
+            self.assertEqual(loaded.get(self.file_path, self.file_path.stat()), checksum)
+        file_md5.assert_not_called()
+
+    def test_invalid_cache_file(self):
+        test_data = [
+            ["not json", "not json"],
+            ["not an object", "[]"],
+        ]
+
+        for name, content in test_data:
+            with self.subTest(name):
+                self.cache_path.write_text(content)
+
+                cache = drpg.sync._ChecksumCache(self.cache_path)
+                checksum = cache.get(self.file_path, self.file_path.stat())
+                self.assertEqual(checksum, md5(self.content).hexdigest())
+                cache.save(prune=True)
+
+    def test_save_prunes_unchecked_files(self):
+        other_path = self.file_path.with_name("other.pdf")
+        other_path.write_bytes(self.content)
+        cache = drpg.sync._ChecksumCache(self.cache_path)
+        cache.get(self.file_path, self.file_path.stat())
+        cache.get(other_path, other_path.stat())
+        cache.save()
+
+        cache = drpg.sync._ChecksumCache(self.cache_path)
+        cache.get(self.file_path, self.file_path.stat())
+        cache.save(prune=True)
+
+        saved = json.loads(self.cache_path.read_text())
+        self.assertEqual(list(saved), [str(self.file_path)])
+
+    def test_save_unchanged(self):
+        drpg.sync._ChecksumCache(self.cache_path).save()
+        self.assertFalse(self.cache_path.exists())
+
+
 class NewestChecksumTest(TestCase):
     def test_no_checksums(self):
         checksum = drpg.sync._newest_checksum({"checksums": []})
         self.assertIsNone(checksum)
 
+    def test_newest_date(self):
+        dates = ["2023-12-31T23:59:59", "2024-01-02T00:00:00", "2024-01-01T12:00:00"]
+        checksums = [types.Checksum(checksum=date, checksumDate=date) for date in dates]
+
+        checksum = drpg.sync._newest_checksum({"checksums": checksums})
+        self.assertEqual(checksum, max(dates, key=datetime.fromisoformat))
+
+
+class TimestampTest(TestCase):
+    def test_naive_date_is_utc(self):
+        self.assertEqual(drpg.sync._timestamp("1970-01-02T00:00:00"), 86400)
+
+    def test_aware_date(self):
+        self.assertEqual(drpg.sync._timestamp("1970-01-02T01:00:00+01:00"), 86400)
+
+    def test_cached(self):
+        drpg.sync._timestamp.cache_clear()
+        self.addCleanup(drpg.sync._timestamp.cache_clear)
+
+        drpg.sync._timestamp("1970-01-02T00:00:00")
+        drpg.sync._timestamp("1970-01-02T00:00:00")
 
-def _checksum_date_now() -> str:
-    return datetime.now().isoformat()
+        self.assertEqual(drpg.sync._timestamp.cache_info().hits, 1)